@@ -15,6 +15,7 @@ particular show. A collage is then created to compactify to the best ability all
 so that the user can get a feel for a user's taste/preferences.
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import jikanpy
 
 import src.url_utils
@@ -33,7 +34,7 @@ def main(username, force, rate_limit, blur_factor, blur_radius):
         force:
             Forces data to be repulled from MyAnimeList even if a cached version exists.
         rate_limit: float
-            Rate limit to sleep between MAL queries.
+            Minimum time between the start of consecutive MAL queries.
         blur_factor:
             Number of times to apply a blurring operation to diffuse wasted space.
         blur_radius:
@@ -50,9 +51,17 @@ def main(username, force, rate_limit, blur_factor, blur_radius):
 
         raise err
 
+    # images come from MAL's CDN so are fetched alongside the rate limited metadata
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        images = executor.submit(src.url_utils.fetch_images, user_animes, force)
+        metadata = executor.submit(
+            src.url_utils.fetch_anime_metadata, jikan, user_animes, force, rate_limit
+        )
+
+    # metadata first so a Jikan error is reported even if a download also failed
     try:
-        src.url_utils.fetch_images(user_animes, force, rate_limit)
-        src.url_utils.fetch_anime_metadata(jikan, user_animes, force, rate_limit)
+        metadata.result()
+        downloaded_images = images.result()
     except jikanpy.exceptions.APIException as err:
         code = err.args[0].split(" ", 1)[0]
         if code == "429":
@@ -75,7 +84,9 @@ def main(username, force, rate_limit, blur_factor, blur_radius):
 
         raise err
 
-    src.collage.draw(user_animes, username, blur_factor, blur_radius)
+    src.collage.draw(
+        user_animes, downloaded_images, username, blur_factor, blur_radius, force
+    )
 
 
 def parse_arguments():
@@ -116,7 +127,10 @@ def parse_arguments():
         default=1,
         type=float,
         dest="rate_limit",
-        help="Rate limit to sleep between MAL queries. Must be at least 0.1.",
+        help=(
+            "Minimum time between the start of consecutive MAL queries."
+            " Must be at least 0.1."
+        ),
     )
 
     parser.add_argument(
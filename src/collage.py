@@ -2,19 +2,40 @@
 """
 Module devoted to the artistic rendering/visualization of images.
 """
+import glob
+import hashlib
+import io
 import json
 import os
 import re
 
 import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image, ImageFilter
+from PIL import Image
 import rpack
+from scipy.signal import fftconvolve
 
-from src.url_utils import IMGDIR, ANIMEDIR
+from src.url_utils import ANIMEDB, IMGDIR, load_anime_metadata
 
 OUTPUTDIR = "output"
 
+# side of the square posters are packed into relative to the square of equal area
+PACKING_SLACK = 1.2
+
+# peak memory of drawing is the collage's three colour channels and deadspace flag,
+# plus when diffusing deadspace the stacked float32 planes and FFT buffers, measured
+# at about 66 bytes per pixel of the halo padded window and rounded up to 72 to leave
+# headroom for the smaller temporaries that scale with the deadspace
+COLLAGE_BYTES_PER_PIXEL = 4
+DIFFUSION_BYTES_PER_PIXEL = 72
+MAX_DRAWING_BYTES = 2 * 2 ** 30
+
+# fraction of the collage below which deadspace is filled flat rather than diffused
+MIN_DIFFUSED_DEADSPACE = 0.02
+
+# matches hours optionally followed by minutes e.g. "1 hr 30 min", or minutes alone
+DURATION_RE = re.compile(r"(\d+) hr(?:\D*?(\d+) min)?|(\d+) min")
+
 
 def parse_duration(duration):
     """
@@ -28,43 +49,46 @@ def parse_duration(duration):
         time: int
             Time to watch in minutes
     """
-    time = 0
-    for scale, unit in ((60, "hr"), (1, "min")):
-        substring = re.search(r"(\d+) {unit}".format(unit=unit), duration)
-        if substring:
-            time += scale * int(substring.group(1))
+    match = DURATION_RE.search(duration)
+    if not match:
+        return 0
+
+    hours, minutes, only_minutes = match.groups()
 
-    return time
+    return 60 * int(hours or 0) + int(minutes or only_minutes or 0)
 
 
-def read_time_poster_data(user_animes):
+def read_time_poster_data(user_animes, downloaded_images):
     """
     Pairs time invested with poster for a list of animes.
 
     Arguments:
         user_animes: list(dict)
             Metadata regarding MAL anime shows.
+        downloaded_images: dict(int, bytes)
+            Encoded posters already in memory keyed by MyAnimeList id, other posters
+            are read from disk.
 
     Returns:
         time_posters: tuple(int, PIL.Image)
             Time in minutes for a given anime paired with corresponding poster.
     """
+    user_animes = [x for x in user_animes if x["watched_episodes"] != 0]
+    anime_metadata = load_anime_metadata(x["mal_id"] for x in user_animes)
+
     time_invested = []
     for anime in user_animes:
-        if anime["watched_episodes"] == 0:
-            continue
-
-        fpath = os.path.join(ANIMEDIR, str(anime["mal_id"])) + ".json"
-        try:
-            with open(fpath, "r") as fptr:
-                metadata = json.load(fptr)
-        except FileNotFoundError:
-            print(f"Skipping due to unfound metadata file for: {anime['title']}")
+        metadata = anime_metadata.get(anime["mal_id"])
+        if metadata is None:
+            print(f"Skipping due to unfound metadata for: {anime['title']}")
             continue
 
         fpath = os.path.join(IMGDIR, str(anime["mal_id"])) + ".jpg"
         try:
-            img = Image.open(fpath)
+            if anime["mal_id"] in downloaded_images:
+                img = Image.open(io.BytesIO(downloaded_images[anime["mal_id"]]))
+            else:
+                img = Image.open(fpath)
         except FileNotFoundError:
             print(f"Skipping due to unfound image file for: {anime['title']}")
             continue
@@ -92,7 +116,7 @@ def normalize_posters(time_posters):
 
     where t is the length each size is rescaled by. Thus to resize an image by an area
     scaler while maintaining the aspect ratio one must resize based on the square root
-    of the area scalar of one side and derive the rest from that quantity.
+    of the area scalar to both sides.
 
     Arguments:
         time_posters: tuple(int, PIL.Image)
@@ -102,115 +126,331 @@ def normalize_posters(time_posters):
         norm_time_posters: tuple(float, PIL.Image)
             Normalized instances of time and area for time and posters respectively.
     """
+    # without any time invested there is nothing to normalize against
+    if not any(x for x, _ in time_posters):
+        return []
 
-    # time_posters = sorted(time_posters, key=lambda x: x[0], reverse=True)
-    max_time = max(x for x, _ in time_posters)
-    max_area = max(x.size[0] * x.size[1] for _, x in time_posters)
+    times = np.array([x for x, _ in time_posters], dtype=float)
+    widths = np.array([x.size[0] for _, x in time_posters])
+    heights = np.array([x.size[1] for _, x in time_posters])
+    areas = widths * heights
 
-    normalized_posters = []
-    for time, img in time_posters:
-        area_norm_ratio = max_area / (img.size[0] * img.size[1])
-        time_norm_ratio = time / max_time
-        ratio = area_norm_ratio * time_norm_ratio
+    area_norm_ratios = areas.max() / areas
+    time_norm_ratios = times / times.max()
+    scales = np.sqrt(area_norm_ratios * time_norm_ratios)
 
-        img = resize_width_w_constant_aspect(ratio, img)
+    new_widths = (scales * widths).astype(int)
+    new_heights = (scales * heights).astype(int)
 
-        if img:
-            normalized_posters.append(img)
+    normalized_posters = []
+    for (_, img), width, height in zip(time_posters, new_widths, new_heights):
+        # integer resolution may be too small to create a finite area
+        if width >= 1 and height >= 1:
+            normalized_posters.append(resize_poster(img, (int(width), int(height))))
 
     return normalized_posters
 
 
-def resize_width_w_constant_aspect(ratio, img):
+def resize_poster(img, size):
     """
-    Resizes an image by a change of width while maintaining aspect ratio.
+    Resizes a poster to the given resolution.
 
     Arguments:
-        ratio: float
-            Ratio to resize width by
         img: PIL.Image
             Image to be resized
+        size: tuple(int, int)
+            Width and height to resize to.
 
     Returns:
-        img: PIL.Image | None
-            Resized Image or None if integer resolution is to small to create a finite
-            area.
+        img: PIL.Image
+            Resized RGB image.
     """
-    width = np.sqrt(ratio) * img.size[0]
-    height = width * img.size[0] / img.size[1]
+    # posters are opened lazily, so JPEGs can be decoded straight to the smallest
+    # power of two reduction no smaller than the target instead of at full resolution
+    img.draft("RGB", size)
 
-    if height >= 1 and width >= 1:
-        return img.resize(map(int, (height, width)), Image.ANTIALIAS)
+    # palette and greyscale posters are resampled on a slower path and would not
+    # fit the collage's RGB channels anyway
+    if img.mode != "RGB":
+        img = img.convert("RGB")
 
-    return None
+    return img.resize(size, Image.LANCZOS)
 
 
-def arrange_images(normalized_posters, blur_factor, blur_radius):
+def gaussian_radius(sigma):
+    """
+    Radius at which a Gaussian is truncated.
+
+    Arguments:
+        sigma: float
+            Standard deviation of the Gaussian in pixels.
+
+    Returns:
+        radius: int
+            Four standard deviations rounded to the nearest pixel.
+    """
+    return int(4 * sigma + 0.5)
+
+
+def gaussian_kernel(sigma):
+    """
+    Builds a 2D Gaussian kernel truncated at four standard deviations.
+
+    Arguments:
+        sigma: float
+            Standard deviation of the Gaussian in pixels.
+
+    Returns:
+        kernel: np.array
+            Square kernel normalized to sum to one.
+    """
+    radius = gaussian_radius(sigma)
+    offsets = np.arange(-radius, radius + 1)
+    profile = np.exp(-0.5 * (offsets / sigma) ** 2)
+    kernel = np.outer(profile, profile)
+
+    return kernel / kernel.sum()
+
+
+def pack_posters(sizes):
+    """
+    Packs posters into a roughly square bounding box.
+
+    Left unconstrained the packer minimizes area with long thin strips, which make for
+    a poor collage. Bounding both sides to a square with some slack over the total
+    poster area keeps the collage compact and greatly narrows the packer's search.
+
+    Arguments:
+        sizes: list(tuple(int, int))
+            Width and height of each poster.
+
+    Returns:
+        positions: list(tuple(int, int))
+            Top left corner of each poster.
+    """
+    side = PACKING_SLACK * np.sqrt(sum(w * h for w, h in sizes))
+    max_width = max(int(side), max(w for w, _ in sizes))
+    max_height = max(int(side), max(h for _, h in sizes))
+
+    try:
+        return rpack.pack(sizes, max_width=max_width, max_height=max_height)
+    except rpack.PackingImpossibleError:
+        return rpack.pack(sizes)
+
+
+def arrange_images(normalized_posters):
     """
     Arranges images to create a collage.
 
     Arguments:
         norm_time_posters: tuple(float, PIL.Image)
             Normalized instances of time and area for time and posters respectively.
-        blur_factor:
-            Number of times to apply a blurring operation to diffuse wasted space.
-        blur_radius:
-            Radius of neighbourhood for use as Gaussian blurring parameter.
 
     Returns:
         collage: np.array
             A collage of images heuristically packed together.
+        deadspace: np.array
+            Boolean mask of collage pixels not covered by any image.
     """
 
-    # as a greedy heuristic sort by size first to minimize wasted area
-    normalized_posters = sorted(
-        normalized_posters, key=lambda x: x.size[0] * x.size[1], reverse=True
-    )
     sizes = [x.size for x in normalized_posters]
-    positions = rpack.pack(sizes)
+    positions = pack_posters(sizes)
 
-    max_width = max(a[0] + b[0] for a, b in zip(positions, sizes))
-    max_height = max(a[1] + b[1] for a, b in zip(positions, sizes))
-    collage = np.full([max_height + 1, max_width + 1, 3], 255, dtype=np.uint8)
-    deadspace = np.full_like(collage, True)
+    max_width, max_height = rpack.bbox_size(sizes, positions)
+    collage = np.full([max_height, max_width, 3], 255, dtype=np.uint8)
+    deadspace = np.ones(collage.shape[:2], dtype=np.bool_)
 
     # place images
     for (x, y), img in zip(positions, normalized_posters):
         dx, dy = img.size
-        collage[y : y + dy, x : x + dx] = img
+        collage[y : y + dy, x : x + dx] = np.asarray(img)
         deadspace[y : y + dy, x : x + dx] = False
 
-    # identify all deadspace which looks harsh on the eyes
-    deadspace = np.where(deadspace)
+    return collage, deadspace
+
 
-    # diffuse deadspace to get a softer background
-    gaussian_blur = ImageFilter.GaussianBlur(radius=blur_radius)
-    for _ in range(blur_factor):
-        blurred = Image.fromarray(collage).filter(gaussian_blur)
-        collage[deadspace] = np.array(blurred)[deadspace]
+def fill_deadspace(collage, deadspace):
+    """
+    Fills the deadspace of a collage with the mean colour of its images.
+
+    Arguments:
+        collage: np.array
+            A collage of images heuristically packed together, modified in place.
+        deadspace: np.array
+            Boolean mask of collage pixels not covered by any image.
+
+    Returns:
+        collage: np.array
+            The collage with a flat background.
+    """
+    # weighted sum over poster pixels rather than gathering them into a copy
+    posters = ~deadspace
+    colour = np.einsum(
+        "ij,ijc->c", posters, collage, dtype=np.float64, casting="unsafe"
+    )
+    collage[deadspace] = np.rint(colour / posters.sum())
 
     return collage
 
 
-def draw(user_animes, username, blur_factor, blur_radius):
+def diffuse_deadspace(collage, deadspace, blur_factor, blur_radius):
+    """
+    Diffuses colours of images into the deadspace of a collage.
+
+    Arguments:
+        collage: np.array
+            A collage of images heuristically packed together, modified in place.
+        deadspace: np.array
+            Boolean mask of collage pixels not covered by any image.
+        blur_factor:
+            Number of blurring operations the diffusion of wasted space is equivalent
+            to.
+        blur_radius:
+            Radius of neighbourhood for use as Gaussian blurring parameter.
+
+    Returns:
+        collage: np.array
+            The collage with a softened background.
+    """
+    # identify all deadspace which looks harsh on the eyes, a blur without passes or
+    # radius leaves it untouched
+    if blur_factor <= 0 or blur_radius <= 0 or not deadspace.any():
+        return collage
+
+    # a sliver of deadspace is not worth diffusing, a flat fill is hardly noticeable
+    if deadspace.mean() < MIN_DIFFUSED_DEADSPACE:
+        return fill_deadspace(collage, deadspace)
+
+    # repeatedly blurring while holding posters in place diffuses their colours into
+    # the deadspace. This is approximated in a single pass by a normalized convolution,
+    # i.e. a poster-only blur divided by the blurred poster coverage, with a Gaussian as
+    # wide as blur_factor successive blurs of blur_radius.
+    sigma = blur_radius * np.sqrt(blur_factor)
+
+    # only pixels within the kernel's support of the deadspace bounding box can
+    # influence the deadspace, so restrict blurring to that window
+    halo = gaussian_radius(sigma)
+    rows = np.flatnonzero(deadspace.any(axis=1))
+    cols = np.flatnonzero(deadspace.any(axis=0))
+    y0, y1 = max(rows[0] - halo, 0), rows[-1] + halo + 1
+    x0, x1 = max(cols[0] - halo, 0), cols[-1] + halo + 1
+    window = collage[y0:y1, x0:x1]
+    mask = deadspace[y0:y1, x0:x1]
+
+    # the transforms are padded by the kernel on top of the window
+    height, width = mask.shape
+    peak = DIFFUSION_BYTES_PER_PIXEL * (height + 2 * halo) * (width + 2 * halo)
+    if COLLAGE_BYTES_PER_PIXEL * deadspace.size + peak > MAX_DRAWING_BYTES:
+        print(
+            f"Diffusing deadspace would need over {MAX_DRAWING_BYTES / 2 ** 30:.0f} "
+            "GiB, filling it flat instead."
+        )
+        return fill_deadspace(collage, deadspace)
+
+    kernel = gaussian_kernel(sigma)
+
+    # the three colour channels and the coverage are stacked into one buffer so they
+    # share a single transform of the kernel, and the division is carried out for
+    # deadspace pixels only. Single precision halves the memory traffic of the
+    # transforms and is ample for 8-bit colour.
+    weights = (~mask).astype(np.float32)
+    planes = np.dstack([window * weights[..., None], weights])
+    kernel = kernel[..., None].astype(np.float32)
+    blurred = fftconvolve(planes, kernel, mode="same", axes=(0, 1))[mask]
+
+    # fall back to the mean poster colour, or white should no poster be in reach
+    background = planes.sum(axis=(0, 1), dtype=np.float64)
+    if background[3] > 0:
+        background = background[:3] / background[3]
+    else:
+        background = np.full(3, 255.0)
+    diffused = np.tile(background, (len(blurred), 1))
+    # coverage below single precision round-off of the transforms is noise
+    reachable = blurred[:, 3] > 1e-3
+    diffused[reachable] = blurred[reachable, :3] / blurred[reachable, 3:]
+    window[mask] = np.rint(diffused)
+
+    return collage
+
+
+def layout_cache_key(user_animes):
+    """
+    Fingerprints the inputs a collage layout is built from.
+
+    Arguments:
+        user_animes: list(dict)
+            Metadata regarding MAL anime shows.
+
+    Returns:
+        key: str
+            Hex digest changing whenever watched episodes or cached data change.
+    """
+    fingerprint = []
+    for anime in user_animes:
+        fpath = os.path.join(IMGDIR, str(anime["mal_id"])) + ".jpg"
+        mtime = os.path.getmtime(fpath) if os.path.isfile(fpath) else None
+        fingerprint.append((anime["mal_id"], anime["watched_episodes"], mtime))
+
+    mtime = os.path.getmtime(ANIMEDB) if os.path.isfile(ANIMEDB) else None
+    fingerprint = json.dumps([sorted(fingerprint), mtime])
+
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+
+
+def draw(user_animes, downloaded_images, username, blur_factor, blur_radius, force):
     """
     Draws a collage of posters proportional in size to time spent thus far watching.
 
+    The arranged collage is cached so that rerunning with different blurring
+    parameters only repeats the diffusion of deadspace.
+
     Arguments:
         user_animes: list(dict)
             Metadata regarding MAL anime shows.
+        downloaded_images: dict(int, bytes)
+            Encoded posters already in memory keyed by MyAnimeList id.
         username:
             MyAnimeList username to query for list of episodes watched of anime.
         blur_factor:
             Number of times to apply a blurring operation to diffuse wasted space.
         blur_radius:
             Radius of neighbourhood for use as Gaussian blurring parameter.
+        force: bool
+            Forces the collage to be rearranged even if a cached layout exists.
     """
-    time_posters = read_time_poster_data(user_animes)
-    normalized_posters = normalize_posters(time_posters)
-
-    print("Generating final image this may take a while.")
-    img = arrange_images(normalized_posters, blur_factor, blur_radius)
+    prefix = os.path.join(OUTPUTDIR, username)
+    layout_fpath = f"{prefix}.{layout_cache_key(user_animes)}.npz"
+    if not force and os.path.isfile(layout_fpath):
+        print(f"Using cached layout located at:\n\t{layout_fpath}")
+        with np.load(layout_fpath) as layout:
+            collage, deadspace = layout["collage"], layout["deadspace"]
+    else:
+        time_posters = read_time_poster_data(user_animes, downloaded_images)
+        normalized_posters = normalize_posters(time_posters)
+        if not normalized_posters:
+            print("No watched episodes with available data.")
+            return
+
+        # posters alone bound the collage's size from below, whether its deadspace
+        # can be diffused within budget is only known once packed
+        area = sum(x.size[0] * x.size[1] for x in normalized_posters)
+        if COLLAGE_BYTES_PER_PIXEL * area > MAX_DRAWING_BYTES:
+            print(
+                f"Collage would need over {MAX_DRAWING_BYTES / 2 ** 30:.0f} GiB, "
+                "skipping drawing."
+            )
+            return
+
+        print("Generating final image this may take a while.")
+        collage, deadspace = arrange_images(normalized_posters)
+
+        for fpath in glob.glob(f"{glob.escape(prefix)}.*.npz"):
+            os.remove(fpath)
+
+        print(f"Caching layout at:\n\t{layout_fpath}")
+        np.savez_compressed(layout_fpath, collage=collage, deadspace=deadspace)
+
+    img = diffuse_deadspace(collage, deadspace, blur_factor, blur_radius)
 
     fpath = os.path.join(OUTPUTDIR, username + ".png")
     plt.imsave(fpath, img)
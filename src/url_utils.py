@@ -4,12 +4,127 @@ Module dedicated to interfacing with the jikan API.
 """
 import os
 import json
+import sqlite3
+import threading
 import time
-import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
 
 USERDIR = "data/users"
 IMGDIR = "data/images"
 ANIMEDIR = "data/anime"
+ANIMEDB = "data/anime.db"
+
+# stay well below SQLite's default limit on the number of host parameters
+SQL_BATCH_SIZE = 500
+
+# MAL's image CDN is not subject to the Jikan rate limit
+IMAGE_WORKERS = 8
+
+# seconds to wait on the CDN before giving up on a poster
+IMAGE_TIMEOUT = 30
+
+# pooled connections let downloads reuse TCP and TLS sessions with the CDN
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=IMAGE_WORKERS))
+
+# cap on freshly downloaded posters kept in memory for drawing
+MAX_DOWNLOADED_BYTES = 2 ** 30
+
+
+class RateLimiter:
+    """
+    Spaces out calls to at most one per interval.
+
+    Unlike sleeping a fixed interval after every call, time already spent waiting on a
+    response counts towards the interval so calls only stall when they would otherwise
+    exceed the rate.
+
+    Arguments:
+        interval: float
+            Minimum number of seconds between the start of consecutive calls.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the next call is permitted and reserves it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def open_anime_db():
+    """
+    Opens the anime metadata cache, migrating legacy per-anime JSON files when empty.
+
+    Returns:
+        conn: sqlite3.Connection
+            Connection to a database with metadata JSON encoded in the meta table.
+    """
+    conn = sqlite3.connect(ANIMEDB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS meta (mal_id INTEGER PRIMARY KEY, blob TEXT)"
+    )
+
+    # an interrupted migration is rolled back, leaving the table empty to retry
+    empty = conn.execute("SELECT 1 FROM meta LIMIT 1").fetchone() is None
+    if empty and os.path.isdir(ANIMEDIR):
+        print(f"Migrating cached metadata from {ANIMEDIR} to:\n\t{ANIMEDB}")
+        rows = []
+        for fname in os.listdir(ANIMEDIR):
+            mal_id, ext = os.path.splitext(fname)
+            if ext == ".json" and mal_id.isdigit():
+                with open(os.path.join(ANIMEDIR, fname), "r") as fptr:
+                    rows.append((int(mal_id), fptr.read()))
+
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", rows)
+
+    return conn
+
+
+def load_anime_metadata(mal_ids):
+    """
+    Reads cached anime metadata.
+
+    Arguments:
+        mal_ids: list(int)
+            MyAnimeList ids of the animes to read metadata for.
+
+    Returns:
+        metadata: dict(int, dict)
+            Metadata of each anime keyed by MyAnimeList id, animes without cached
+            metadata are absent.
+    """
+    mal_ids = list(mal_ids)
+    metadata = {}
+
+    conn = open_anime_db()
+    try:
+        for i in range(0, len(mal_ids), SQL_BATCH_SIZE):
+            batch = mal_ids[i : i + SQL_BATCH_SIZE]
+            query = "SELECT mal_id, blob FROM meta WHERE mal_id IN ({})".format(
+                ", ".join("?" * len(batch))
+            )
+            for mal_id, blob in conn.execute(query, batch):
+                metadata[mal_id] = json.loads(blob)
+    finally:
+        conn.close()
+
+    return metadata
 
 
 def fetch_user_animes(jikan, username, force):
@@ -47,28 +162,71 @@ def fetch_user_animes(jikan, username, force):
     return user_animes
 
 
-def fetch_images(user_animes, force, rate_limit):
+def fetch_image(anime):
+    """
+    Downloads and saves the poster of an anime.
+
+    Arguments:
+        anime: dict
+            Metadata regarding a MAL anime show.
+
+    Returns:
+        content: bytes
+            Encoded poster as downloaded.
+    """
+    img_fpath = os.path.join(IMGDIR, f"{anime['mal_id']}.jpg")
+    print(f"Saving image for: {anime['title']}")
+    response = SESSION.get(anime["image_url"], timeout=IMAGE_TIMEOUT)
+    response.raise_for_status()
+    content = response.content
+
+    with open(img_fpath, "wb") as fptr:
+        fptr.write(content)
+
+    return content
+
+
+def fetch_images(user_animes, force):
     """
     Queries and saves images associated with MAL username's watchlist.
 
+    Images are served from MAL's CDN rather than the Jikan API and so are downloaded
+    concurrently without rate limiting.
+
     Arguments:
         user_animes: list(dict)
             Metadata regarding MAL anime shows.
         force: bool
             Forces data to be queried from MyAnimeList even if a cached version exists.
-        rate_limit: float
-            Rate limit to sleep between MAL queries.
+
+    Returns:
+        downloaded_images: OrderedDict(int, bytes)
+            Encoded posters downloaded by this call keyed by MyAnimeList id, so they
+            need not be read back from disk. Oldest downloads are dropped to keep the
+            total under MAX_DOWNLOADED_BYTES.
     """
+    uncached_animes = []
     for anime in user_animes:
         img_fpath = os.path.join(IMGDIR, f"{anime['mal_id']}.jpg")
         cache_exists = os.path.exists(img_fpath) and os.path.isfile(img_fpath)
         if force or not cache_exists:
-            print(f"Saving image for: {anime['title']}")
-            urllib.request.urlretrieve(anime["image_url"], img_fpath)
-            time.sleep(rate_limit)
+            uncached_animes.append(anime)
         else:
             print(f"Skipping already cached image for: {anime['title']}")
 
+    downloaded_images = OrderedDict()
+    downloaded_bytes = 0
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+        contents = executor.map(fetch_image, uncached_animes)
+        for anime, content in zip(uncached_animes, contents):
+            downloaded_images[anime["mal_id"]] = content
+            downloaded_bytes += len(content)
+            while downloaded_bytes > MAX_DOWNLOADED_BYTES:
+                _, evicted = downloaded_images.popitem(last=False)
+                downloaded_bytes -= len(evicted)
+
+    return downloaded_images
+
 
 def fetch_anime_metadata(jikan, user_animes, force, rate_limit):
     """
@@ -82,16 +240,24 @@ def fetch_anime_metadata(jikan, user_animes, force, rate_limit):
         force: bool
             Forces data to be queried from MyAnimeList even if a cached version exists.
         rate_limit: float
-            Rate limit to sleep between MAL queries.
+            Minimum time between the start of consecutive MAL queries.
     """
-    for anime in user_animes:
-        metadata_fpath = os.path.join(ANIMEDIR, f"{anime['mal_id']}.json")
-        cache_exists = os.path.exists(metadata_fpath) and os.path.isfile(metadata_fpath)
-        if force or not cache_exists:
-            print(f"Saving metadata for: {anime['title']}")
-            anime_metadata = jikan.anime(anime["mal_id"])
-            with open(metadata_fpath, "w") as fptr:
-                json.dump(anime_metadata, fptr)
-            time.sleep(rate_limit)
-        else:
-            print(f"Skipping already cached metadata for: {anime['title']}")
+    rate_limiter = RateLimiter(rate_limit)
+    conn = open_anime_db()
+    try:
+        cached_ids = {row[0] for row in conn.execute("SELECT mal_id FROM meta")}
+        for anime in user_animes:
+            if force or anime["mal_id"] not in cached_ids:
+                rate_limiter.wait()
+                print(f"Saving metadata for: {anime['title']}")
+                anime_metadata = jikan.anime(anime["mal_id"])
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    (anime["mal_id"], json.dumps(anime_metadata)),
+                )
+                # commit per anime so progress survives hitting the rate limit
+                conn.commit()
+            else:
+                print(f"Skipping already cached metadata for: {anime['title']}")
+    finally:
+        conn.close()